@@ -1,17 +1,18 @@
 import sys
 import os
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
 import subprocess
 import logging
 import json
 from PyQt5.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QTextEdit, QTreeWidget, QTreeWidgetItem,
     QLineEdit, QApplication, QMenuBar, QMessageBox, QFileDialog, QInputDialog, QStatusBar, QComboBox,
-    QDialog, QTableWidget, QTableWidgetItem, QCompleter
+    QDialog, QTableWidget, QTableWidgetItem, QCompleter, QSpinBox, QCheckBox
 )
 from PyQt5.QtGui import QIcon, QFont
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QStringListModel
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal, QStringListModel
 
 # Configuración de logging
 logging.basicConfig(filename="command_tool.log", level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -20,6 +21,13 @@ logging.basicConfig(filename="command_tool.log", level=logging.INFO, format="%(a
 DATABASE_DIR = "database"
 DATABASE_PATH = os.path.join(DATABASE_DIR, "commands.db")
 
+# Política de retención del historial (0 = sin límite)
+HISTORY_RETENTION_DEFAULTS = {"max_age_days": 0, "max_rows": 0, "collapse_duplicates": True}
+HISTORY_MAINTENANCE_STARTUP_DELAY_MS = 10 * 1000
+HISTORY_MAINTENANCE_INTERVAL_MS = 30 * 60 * 1000
+HISTORY_MAINTENANCE_BATCH_SIZE = 200
+HISTORY_MAINTENANCE_PAUSE_MS = 20
+
 class CommandWorker(QThread):
     output_signal = pyqtSignal(str)
     finished_signal = pyqtSignal()
@@ -41,6 +49,133 @@ class CommandWorker(QThread):
             self.output_signal.emit(f"Error inesperado: {str(e)}")
         self.finished_signal.emit()
 
+class HistoryMaintenanceWorker(QThread):
+    """Aplica la política de retención del historial en segundo plano.
+
+    Trabaja en lotes pequeños, confirmando cada uno por separado, para que la
+    conexión de la interfaz nunca quede bloqueada más que un instante. Los
+    favoritos nunca se eliminan.
+    """
+    finished_signal = pyqtSignal(object)
+
+    def __init__(self, policy, convert_auto_vacuum=False, batch_size=HISTORY_MAINTENANCE_BATCH_SIZE):
+        super().__init__()
+        self.policy = policy
+        self.convert_auto_vacuum = convert_auto_vacuum
+        self.batch_size = batch_size
+        self.conn = None
+
+    def stop(self):
+        self.requestInterruption()
+        # interrupt() puede llamarse desde otro hilo y aborta también un VACUUM en curso
+        conn = self.conn
+        if conn:
+            try:
+                conn.interrupt()
+            except sqlite3.ProgrammingError:
+                pass  # El hilo acaba de cerrar la conexión
+
+    def run(self):
+        stats = {"collapsed": 0, "expired": 0, "trimmed": 0, "reclaimed_bytes": 0, "elapsed": 0.0, "error": None}
+        start = time.monotonic()
+        conn = None
+        try:
+            conn = self.conn = sqlite3.connect(DATABASE_PATH, timeout=10)
+            size_before = self.database_size(conn)
+            if self.convert_auto_vacuum:
+                self.enable_incremental_vacuum(conn)
+            # Primero se borra lo que sobra, para no agrupar filas que se eliminarían después
+            if self.policy.get("max_age_days"):
+                stats["expired"] = self.delete_expired(conn)
+            if self.policy.get("max_rows"):
+                stats["trimmed"] = self.trim_excess(conn)
+            if self.policy.get("collapse_duplicates"):
+                stats["collapsed"] = self.collapse_duplicates(conn)
+            # Sin auto_vacuum incremental las páginas libres se reutilizan, pero no se devuelven al sistema
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                self.incremental_vacuum(conn)
+            stats["reclaimed_bytes"] = max(size_before - self.database_size(conn), 0)
+        except Exception as e:
+            stats["error"] = str(e)
+        finally:
+            self.conn = None
+            if conn:
+                conn.close()
+        stats["elapsed"] = time.monotonic() - start
+        self.finished_signal.emit(stats)
+
+    def database_size(self, conn):
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def enable_incremental_vacuum(self, conn):
+        # El modo auto_vacuum de una base existente solo cambia tras un VACUUM completo, que bloquea la base entera
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+
+    def run_batches(self, conn, batch):
+        # Cada lote devuelve las filas afectadas, o None cuando ya no queda trabajo
+        total = 0
+        while not self.isInterruptionRequested():
+            with conn:
+                affected = batch()
+            if affected is None:
+                break
+            total += affected
+            self.msleep(HISTORY_MAINTENANCE_PAUSE_MS)
+        return total
+
+    def collapse_duplicates(self, conn):
+        last_id = 0
+        def batch():
+            nonlocal last_id
+            # Cada página empieza en la última fila de la anterior para comparar también a través del corte
+            rows = conn.execute("SELECT id, command FROM history WHERE id >= ? ORDER BY id LIMIT ?",
+                                (last_id, self.batch_size + 1)).fetchall()
+            if len(rows) < 2:
+                return None
+            last_id = rows[-1][0]
+            collapsed = 0
+            for (prev_id, prev_command), (row_id, command) in zip(rows, rows[1:]):
+                if command != prev_command:
+                    continue
+                # La lectura anterior no está en la transacción: el favorito se comprueba de nuevo al borrar
+                run_count = conn.execute("SELECT run_count FROM history WHERE id = ?", (prev_id,)).fetchone()
+                if run_count and conn.execute("DELETE FROM history WHERE id = ? AND favorite = 0", (prev_id,)).rowcount == 1:
+                    conn.execute("UPDATE history SET run_count = run_count + ? WHERE id = ?", (run_count[0], row_id))
+                    collapsed += 1
+            return collapsed
+        return self.run_batches(conn, batch)
+
+    def delete_expired(self, conn):
+        cutoff = (datetime.now() - timedelta(days=self.policy["max_age_days"])).strftime("%Y-%m-%d %H:%M:%S")
+        def batch():
+            return conn.execute('''DELETE FROM history WHERE id IN
+                                   (SELECT id FROM history WHERE favorite = 0 AND timestamp < ? LIMIT ?)''',
+                                (cutoff, self.batch_size)).rowcount or None
+        return self.run_batches(conn, batch)
+
+    def trim_excess(self, conn):
+        # Los favoritos no cuentan para el límite de filas; el exceso se cuenta una sola vez
+        excess = conn.execute("SELECT COUNT(*) FROM history WHERE favorite = 0").fetchone()[0] - self.policy["max_rows"]
+        def batch():
+            nonlocal excess
+            if excess <= 0:
+                return None
+            deleted = conn.execute('''DELETE FROM history WHERE id IN
+                                      (SELECT id FROM history WHERE favorite = 0 ORDER BY id LIMIT ?)''',
+                                   (min(excess, self.batch_size),)).rowcount
+            excess -= deleted
+            return deleted or None
+        return self.run_batches(conn, batch)
+
+    def incremental_vacuum(self, conn):
+        while not self.isInterruptionRequested() and conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            conn.execute(f"PRAGMA incremental_vacuum({self.batch_size})").fetchall()
+            self.msleep(HISTORY_MAINTENANCE_PAUSE_MS)
+
 class CommandCompleter(QCompleter):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -224,6 +359,55 @@ class SavedCommandsDialog(QDialog):
                 except sqlite3.IntegrityError:
                     QMessageBox.critical(self, "Error", "El nuevo alias ya existe.")
 
+class HistoryRetentionDialog(QDialog):
+    def __init__(self, policy, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Retención del Historial")
+        self.policy = dict(policy)
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout()
+
+        age_layout = QHBoxLayout()
+        age_layout.addWidget(QLabel("Antigüedad máxima (días, 0 = sin límite):"))
+        self.age_spin = QSpinBox()
+        self.age_spin.setRange(0, 36500)
+        self.age_spin.setValue(self.policy["max_age_days"])
+        age_layout.addWidget(self.age_spin)
+        layout.addLayout(age_layout)
+
+        rows_layout = QHBoxLayout()
+        rows_layout.addWidget(QLabel("Máximo de entradas (0 = sin límite):"))
+        self.rows_spin = QSpinBox()
+        self.rows_spin.setRange(0, 10000000)
+        self.rows_spin.setValue(self.policy["max_rows"])
+        rows_layout.addWidget(self.rows_spin)
+        layout.addLayout(rows_layout)
+
+        self.collapse_check = QCheckBox("Agrupar comandos idénticos consecutivos")
+        self.collapse_check.setChecked(self.policy["collapse_duplicates"])
+        layout.addWidget(self.collapse_check)
+        layout.addWidget(QLabel("Los favoritos se conservan siempre."))
+
+        btn_layout = QHBoxLayout()
+        save_btn = QPushButton("Guardar")
+        save_btn.clicked.connect(self.accept)
+        btn_layout.addWidget(save_btn)
+        cancel_btn = QPushButton("Cancelar")
+        cancel_btn.clicked.connect(self.reject)
+        btn_layout.addWidget(cancel_btn)
+        layout.addLayout(btn_layout)
+
+        self.setLayout(layout)
+
+    def get_policy(self):
+        return {
+            "max_age_days": self.age_spin.value(),
+            "max_rows": self.rows_spin.value(),
+            "collapse_duplicates": self.collapse_check.isChecked()
+        }
+
 class CommandToolApp(QWidget):
     def __init__(self):
         super().__init__()
@@ -233,7 +417,14 @@ class CommandToolApp(QWidget):
         self.create_tables()
         self.working_dir = os.getcwd()
         self.current_theme = "Dark"
+        self.history_policy = dict(HISTORY_RETENTION_DEFAULTS)
+        self.maintenance_worker = None
+        self.closing = False
         self.init_ui()
+        self.maintenance_timer = QTimer(self)
+        self.maintenance_timer.timeout.connect(self.run_history_maintenance)
+        self.maintenance_timer.start(HISTORY_MAINTENANCE_INTERVAL_MS)
+        QTimer.singleShot(HISTORY_MAINTENANCE_STARTUP_DELAY_MS, self.run_history_maintenance)
 
     def init_ui(self):
         self.setWindowTitle("Terminal Avanzada")
@@ -251,6 +442,8 @@ class CommandToolApp(QWidget):
         tools_menu.addAction("Mostrar Comandos Guardados", self.show_saved_commands)
         tools_menu.addAction("Importar Alias", self.import_aliases)
         tools_menu.addAction("Exportar Alias", self.export_aliases)
+        tools_menu.addAction("Retención del Historial", self.edit_history_policy)
+        tools_menu.addAction("Mantenimiento del Historial", self.run_history_maintenance_now)
         theme_menu = menubar.addMenu("Temas")
         for theme in ThemeManager.THEMES.keys():
             theme_menu.addAction(theme, lambda t=theme: self.change_theme(t))
@@ -335,7 +528,7 @@ class CommandToolApp(QWidget):
         self.history_search_entry.textChanged.connect(self.search_history)
         history_layout.addWidget(self.history_search_entry)
         self.history_tree = QTreeWidget()
-        self.history_tree.setHeaderLabels(["Favorito", "Comando", "Fecha y Hora"])
+        self.history_tree.setHeaderLabels(["Favorito", "Comando", "Fecha y Hora", "Veces"])
         self.history_tree.setColumnWidth(0, 50)
         self.history_tree.setColumnWidth(1, 400)
         self.history_tree.itemDoubleClicked.connect(self.run_history_command)
@@ -356,10 +549,17 @@ class CommandToolApp(QWidget):
         self.update_completer()
 
     def create_tables(self):
+        # Solo tiene efecto en bases nuevas; las existentes se convierten desde el mantenimiento manual
+        self.execute_sql("PRAGMA auto_vacuum = INCREMENTAL")
         self.execute_sql('''CREATE TABLE IF NOT EXISTS saved_commands 
                            (id INTEGER PRIMARY KEY, alias TEXT UNIQUE, command TEXT, description TEXT)''')
         self.execute_sql('''CREATE TABLE IF NOT EXISTS history 
-                           (id INTEGER PRIMARY KEY, command TEXT, timestamp TEXT, favorite INTEGER DEFAULT 0)''')
+                           (id INTEGER PRIMARY KEY, command TEXT, timestamp TEXT, favorite INTEGER DEFAULT 0, run_count INTEGER DEFAULT 1)''')
+        history_columns = [row[1] for row in self.execute_sql("PRAGMA table_info(history)")]
+        if "run_count" not in history_columns:
+            self.execute_sql("ALTER TABLE history ADD COLUMN run_count INTEGER DEFAULT 1")
+        # Sirve a load_history (ORDER BY favorite DESC, timestamp DESC) y a la caducidad (favorite = 0 AND timestamp < ?)
+        self.execute_sql("CREATE INDEX IF NOT EXISTS idx_history_favorite_timestamp ON history (favorite, timestamp)")
 
     def execute_sql(self, query, params=None):
         with self.conn:
@@ -402,15 +602,31 @@ class CommandToolApp(QWidget):
             self.worker.finished_signal.connect(self.command_finished)
             self.worker.start()
 
-            self.execute_sql("INSERT INTO history (command, timestamp) VALUES (?, ?)", 
-                           (command, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-            self.load_history()
-            self.update_completer()
+            try:
+                self.add_to_history(command)
+                self.load_history()
+                self.update_completer()
+            except sqlite3.Error as e:
+                # El comando ya se está ejecutando: solo falla el registro en el historial
+                self.status_bar.showMessage(f"No se pudo guardar en el historial: {str(e)}", 5000)
+                logging.error(f"Saving command to history failed: {str(e)}")
         except Exception as e:
             self.status_bar.showMessage(f"Error: {str(e)}", 5000)
             logging.error(f"Command execution failed: {str(e)}")
             self.run_btn.setEnabled(True)
 
+    def add_to_history(self, command):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.conn:
+            last = self.conn.execute("SELECT id, command FROM history ORDER BY id DESC LIMIT 1").fetchone()
+            updated = 0
+            if self.history_policy["collapse_duplicates"] and last and last[1] == command:
+                # El mantenimiento puede haber borrado esa fila tras la lectura; en ese caso se inserta una nueva
+                updated = self.conn.execute("UPDATE history SET run_count = run_count + 1, timestamp = ? WHERE id = ?",
+                                            (timestamp, last[0])).rowcount
+            if not updated:
+                self.conn.execute("INSERT INTO history (command, timestamp) VALUES (?, ?)", (command, timestamp))
+
     def display_output(self, output):
         if output == "CLEAR_TERMINAL":
             self.clear_output()
@@ -501,18 +717,18 @@ class CommandToolApp(QWidget):
 
     def load_history(self):
         self.history_tree.clear()
-        rows = self.execute_sql("SELECT favorite, command, timestamp FROM history ORDER BY favorite DESC, timestamp DESC LIMIT 100")
+        rows = self.execute_sql("SELECT favorite, command, timestamp, run_count FROM history ORDER BY favorite DESC, timestamp DESC LIMIT 100")
         for row in rows or []:
-            item = QTreeWidgetItem(self.history_tree, ["★" if row[0] else "", row[1], row[2]])
+            item = QTreeWidgetItem(self.history_tree, ["★" if row[0] else "", row[1], row[2], str(row[3])])
             item.setTextAlignment(0, Qt.AlignCenter)
 
     def search_history(self):
         search_term = self.history_search_entry.text().lower()
         self.history_tree.clear()
-        rows = self.execute_sql("SELECT favorite, command, timestamp FROM history WHERE command LIKE ? ORDER BY favorite DESC, timestamp DESC", 
+        rows = self.execute_sql("SELECT favorite, command, timestamp, run_count FROM history WHERE command LIKE ? ORDER BY favorite DESC, timestamp DESC", 
                                (f"%{search_term}%",))
         for row in rows:
-            item = QTreeWidgetItem(self.history_tree, ["★" if row[0] else "", row[1], row[2]])
+            item = QTreeWidgetItem(self.history_tree, ["★" if row[0] else "", row[1], row[2], str(row[3])])
             item.setTextAlignment(0, Qt.AlignCenter)
 
     def run_history_command(self, item, column):
@@ -534,9 +750,9 @@ class CommandToolApp(QWidget):
         file_path = QFileDialog.getSaveFileName(self, "Exportar Historial", "", "Text files (*.txt)")[0]
         if file_path:
             with open(file_path, "w", encoding="utf-8") as file:
-                rows = self.execute_sql("SELECT command, timestamp FROM history ORDER BY timestamp DESC")
+                rows = self.execute_sql("SELECT command, timestamp, run_count FROM history ORDER BY timestamp DESC")
                 for row in rows:
-                    file.write(f"{row[1]}: {row[0]}\n")
+                    file.write(f"{row[1]}: {row[0]}" + (f" (x{row[2]})" if row[2] > 1 else "") + "\n")
             self.status_bar.showMessage("Historial exportado correctamente.", 5000)
 
     def export_aliases(self):
@@ -628,6 +844,48 @@ class CommandToolApp(QWidget):
         dialog = SavedCommandsDialog(self)
         dialog.exec_()
 
+    def edit_history_policy(self):
+        dialog = HistoryRetentionDialog(self.history_policy, self)
+        if dialog.exec_() == QDialog.Accepted:
+            self.history_policy = dialog.get_policy()
+            self.save_config()
+            self.status_bar.showMessage("Política de retención actualizada.", 5000)
+
+    def run_history_maintenance(self, convert_auto_vacuum=False):
+        if self.maintenance_worker and self.maintenance_worker.isRunning():
+            return
+        self.maintenance_worker = HistoryMaintenanceWorker(dict(self.history_policy), convert_auto_vacuum)
+        self.maintenance_worker.finished_signal.connect(self.history_maintenance_finished)
+        self.maintenance_worker.start()
+
+    def run_history_maintenance_now(self):
+        if self.maintenance_worker and self.maintenance_worker.isRunning():
+            self.status_bar.showMessage("El mantenimiento del historial ya está en curso.", 5000)
+            return
+        convert_auto_vacuum = False
+        if self.execute_sql("PRAGMA auto_vacuum")[0][0] != 2:
+            convert_auto_vacuum = QMessageBox.question(self, "Mantenimiento del Historial",
+                "Para poder liberar espacio en disco, la base de datos debe reconstruirse una única vez.\n"
+                "Mientras tanto el historial quedará bloqueado y, si la base es grande, puede tardar.\n"
+                "¿Reconstruirla ahora?") == QMessageBox.Yes
+        self.run_history_maintenance(convert_auto_vacuum)
+
+    def history_maintenance_finished(self, stats):
+        if self.closing:
+            return
+        if stats["error"]:
+            logging.error(f"History maintenance failed: {stats['error']}")
+            self.status_bar.showMessage(f"Error en el mantenimiento del historial: {stats['error']}", 5000)
+            return
+        removed = stats["collapsed"] + stats["expired"] + stats["trimmed"]
+        logging.info(f"History maintenance: {stats['collapsed']} collapsed, {stats['expired']} expired, "
+                     f"{stats['trimmed']} trimmed, {stats['reclaimed_bytes']} bytes reclaimed in {stats['elapsed']:.2f}s")
+        self.status_bar.showMessage(f"Historial mantenido: {removed} entradas eliminadas, "
+                                    f"{stats['reclaimed_bytes'] / 1024:.1f} KB liberados en {stats['elapsed']:.2f} s", 5000)
+        if removed:
+            self.load_history()
+            self.update_completer()
+
     def change_theme(self, theme_name):
         self.current_theme = theme_name
         ThemeManager.apply_theme(self, theme_name)
@@ -640,7 +898,8 @@ class CommandToolApp(QWidget):
         config = {
             'working_dir': self.working_dir,
             'window_geometry': self.geometry().getRect(),
-            'theme': self.current_theme
+            'theme': self.current_theme,
+            'history_retention': self.history_policy
         }
         with open('config.json', 'w') as f:
             json.dump(config, f)
@@ -653,11 +912,37 @@ class CommandToolApp(QWidget):
                 self.path_entry.setText(self.working_dir)
                 self.setGeometry(*config.get('window_geometry', (100, 100, 1000, 750)))
                 self.change_theme(config.get('theme', 'Dark'))
+                self.history_policy = self.parse_history_policy(config.get('history_retention'))
         except FileNotFoundError:
             pass
 
+    def parse_history_policy(self, raw_policy):
+        # config.json puede editarse a mano: cada valor inválido vuelve a su valor por defecto
+        policy = dict(HISTORY_RETENTION_DEFAULTS)
+        if not isinstance(raw_policy, dict):
+            return policy
+        for key in ("max_age_days", "max_rows"):
+            value = raw_policy.get(key, policy[key])
+            try:
+                if isinstance(value, bool):
+                    raise TypeError(key)
+                policy[key] = max(int(value), 0)
+            except (TypeError, ValueError):
+                logging.warning(f"Invalid history retention value for {key}: {value!r}")
+        value = raw_policy.get("collapse_duplicates", policy["collapse_duplicates"])
+        if isinstance(value, bool):
+            policy["collapse_duplicates"] = value
+        else:
+            logging.warning(f"Invalid history retention value for collapse_duplicates: {value!r}")
+        return policy
+
     def closeEvent(self, event):
         self.save_config()
+        # Un resultado aún en cola llegaría con self.conn ya cerrada
+        self.closing = True
+        if self.maintenance_worker and self.maintenance_worker.isRunning():
+            self.maintenance_worker.stop()
+            self.maintenance_worker.wait()
         self.conn.close()
         event.accept()
 